@@ -5,7 +5,7 @@
 - Поддерживает разные форматы ввода (TTFT, a-2,b=1, dcbae и т.д.).
 - Автоматически оценивает формализованные вопросы.
 - Сохраняет все ответы в Google Sheets:
-    - all_answers_json (вся структура ответов)
+    - all_answers_json (все ответы, кроме q12/q13 — они уже есть в своих колонках)
     - q12_raw, q13_raw (открытые вопросы отдельно)
     - telegram_id (id студента)
     - manual_score_total (преподаватель вписывает туда итог)
@@ -13,66 +13,131 @@
 - Команда /check_updates (только для ADMIN_CHAT_ID) отправляет студенту в Telegram сообщение после того, как преподаватель проставил manual_score_total.
 """
 import os
-import json
 import time
 import re
-from datetime import datetime
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache, wraps
+from operator import eq
 from dotenv import load_dotenv
 
-import telebot
-from telebot import types
+import ahocorasick
+import orjson
+
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+from aiohttp import web
+import redis.asyncio as redis
 
 import gspread
+from gspread.utils import absolute_range_name
 from google.oauth2.service_account import Credentials
 
 
 # Загрузка конфигурации
 
 load_dotenv()
-TOKEN = os.getenv("TELEGRAM_TOKEN")
-SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE")
-SHEET_NAME = os.getenv("GOOGLE_SHEET_NAME", "TestResults")
-ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")  # строка или пусто
 
-if not TOKEN:
+@dataclass(frozen=True, slots=True)
+class Cfg:
+    """Настройки бота; читаются из окружения один раз при запуске."""
+    token: str
+    sa_file: str | None
+    sheet_name: str
+    admin: str | None  # ADMIN_CHAT_ID: строка или пусто
+    public_url: str | None  # внешний адрес сервиса для webhook, без завершающего /
+    port: int
+    redis_url: str | None  # если не задан, сессии хранятся в памяти процесса
+
+CFG = Cfg(
+    token=os.getenv("TELEGRAM_TOKEN"),
+    sa_file=os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE"),
+    sheet_name=os.getenv("GOOGLE_SHEET_NAME", "TestResults"),
+    admin=os.getenv("ADMIN_CHAT_ID"),
+    public_url=os.getenv("PUBLIC_URL"),
+    port=int(os.getenv("PORT", "5000")),
+    redis_url=os.getenv("REDIS_URL"),
+)
+
+if not CFG.token:
     raise RuntimeError("TELEGRAM_TOKEN не задан в .env")
 
-bot = telebot.TeleBot(TOKEN)
+bot = AsyncTeleBot(CFG.token)
 
 # Загрузка тестов из tests/
 
 TESTS_DIR = "tests"
 
+def _load_one(fname):
+    """Читает и разбирает один файл теста. При ошибке возвращает None."""
+    path = os.path.join(TESTS_DIR, fname)
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except Exception as e:
+        print(f"Не удалось загрузить тест {fname}: {e}")
+        return None
+
 def load_tests():
-    tests = {}
     if not os.path.exists(TESTS_DIR):
         os.makedirs(TESTS_DIR)
-    for fname in os.listdir(TESTS_DIR):
-        if fname.lower().endswith(".json"):
-            path = os.path.join(TESTS_DIR, fname)
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    tests[data["id"]] = data
-            except Exception as e:
-                print(f"Не удалось загрузить тест {fname}: {e}")
+    files = [f for f in os.listdir(TESTS_DIR) if f.lower().endswith(".json")]
+    # файлы читаются параллельно, порядок результатов совпадает с порядком files
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        results = list(ex.map(_load_one, files))
+    tests = {}
+    for fname, data in zip(files, results):
+        if data is None:
+            continue
+        try:
+            for q in data.get("questions", []):
+                prepare_question(q)
+            tests[data["id"]] = data
+        except Exception as e:
+            print(f"Не удалось загрузить тест {fname}: {e}")
     return tests
 
-TESTS = load_tests()
+# Google Sheets 
+# Google отвечает 429 при превышении квоты запросов в минуту и 5xx при временных сбоях:
+# такие вызовы повторяем с экспоненциальной задержкой (или паузой из Retry-After).
 
+SHEET_RETRY_STATUSES = (429, 500, 502, 503, 504)
+SHEET_RETRY_ATTEMPTS = 6
+SHEET_RETRY_MAX_DELAY = 60
 
-# Google Sheets 
+def _is_retryable(e):
+    return e.response.status_code in SHEET_RETRY_STATUSES
+
+def _retry_delay(e, delay):
+    """Пауза перед повтором: Retry-After из ответа Google, если он есть, иначе delay (не больше SHEET_RETRY_MAX_DELAY)."""
+    retry_after = e.response.headers.get("Retry-After", "")
+    return min(float(retry_after) if retry_after.isdigit() else delay, SHEET_RETRY_MAX_DELAY)
+
+def _with_retry(fn, *args, **kwargs):
+    """Вызывает gspread-функцию, повторяя её при 429/5xx (синхронно, до SHEET_RETRY_ATTEMPTS раз)."""
+    delay = 1.0
+    for attempt in range(SHEET_RETRY_ATTEMPTS):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if not _is_retryable(e) or attempt == SHEET_RETRY_ATTEMPTS - 1:
+                raise
+            time.sleep(_retry_delay(e, delay))
+            delay *= 2
 
 gc = None
 sheet = None
-if SERVICE_ACCOUNT_FILE and os.path.exists(SERVICE_ACCOUNT_FILE):
+if CFG.sa_file and os.path.exists(CFG.sa_file):
     scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-    creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=scopes)
+    creds = Credentials.from_service_account_file(CFG.sa_file, scopes=scopes)
     gc = gspread.authorize(creds)
     try:
-        sh = gc.open(SHEET_NAME)
+        sh = _with_retry(gc.open, CFG.sheet_name)
     except gspread.SpreadsheetNotFound:
-        sh = gc.create(SHEET_NAME)
+        sh = _with_retry(gc.create, CFG.sheet_name)
     sheet = sh.sheet1
 else:
     print("⚠️ Google service account file не найден. Запись результатов отключена.")
@@ -87,40 +152,133 @@ BASE_HEADER = [
 ]
 
 def ensure_sheet_header():
-    if not sheet:
-        return
-    current = sheet.row_values(1)
+    """Проверяет первую строку таблицы, при необходимости дописывает BASE_HEADER и возвращает заголовок."""
+    current = _with_retry(sheet.row_values, 1)
     if current[:len(BASE_HEADER)] != BASE_HEADER:
         extra = current[len(BASE_HEADER):] if len(current) > len(BASE_HEADER) else []
-        new_header = BASE_HEADER + extra
-        sheet.update("A1", [new_header])
+        current = BASE_HEADER + extra
+        _with_retry(sheet.update, "A1", [current])
+    return current
 
-if sheet:
-    ensure_sheet_header()
+# Заголовок кэшируется в памяти: порядок колонок меняется редко,
+# поэтому row_values(1) перечитывается только после ошибки записи.
+HEADER_CACHE = list(BASE_HEADER)
+INDEX_CACHE = {h: i+1 for i,h in enumerate(HEADER_CACHE)}
 
+def refresh_header_cache():
+    """Перечитывает заголовок из таблицы и обновляет HEADER_CACHE / INDEX_CACHE (индексы 1-based)."""
+    global HEADER_CACHE, INDEX_CACHE
+    header = ensure_sheet_header()
+    HEADER_CACHE, INDEX_CACHE = header, {h: i+1 for i,h in enumerate(header)}
 
-# Временное состояние пользователей (в памяти)
-
+if sheet:
+    refresh_header_cache()
+
+
+# Состояние пользователей
+# При заданном REDIS_URL сессии хранятся в Redis (общие для всех процессов и переживают
+# перезапуск), иначе — в памяти процесса.
+
+SESSION_TTL = 3600  # секунд с последнего ответа
+
+@dataclass(slots=True)
+class UserState:
+    """Состояние прохождения теста одним пользователем."""
+    test_id: str
+    telegram_id: int  # сохраняем id студента
+    student_username: str = ""
+    stage: str = "get_name"
+    index: int = 0
+    answers: dict = field(default_factory=dict)
+    start_time: float = field(default_factory=time.time)
+    attempt: int = 1
+    student_name: str = ""
+    group: str = ""
+
+    @property
+    def test(self):
+        return TESTS[self.test_id]
+
+redis_client = redis.Redis.from_url(CFG.redis_url) if CFG.redis_url else None
 user_states = {}
 
-def start_test_for_user(chat_id, test_id, tg_user):
+def _session_key(chat_id):
+    return f"sess:{chat_id}"
+
+async def get_state(chat_id):
+    if redis_client is None:
+        return user_states.get(chat_id)
+    raw = await redis_client.get(_session_key(chat_id))
+    if not raw:
+        return None
+    state = UserState(**orjson.loads(raw))
+    # тест мог быть удалён из tests/ между перезапусками
+    return state if state.test_id in TESTS else None
+
+async def set_state(chat_id, state):
+    if redis_client is None:
+        user_states[chat_id] = state
+    else:
+        await redis_client.set(_session_key(chat_id), orjson.dumps(state), ex=SESSION_TTL)
+
+async def pop_state(chat_id):
+    if redis_client is None:
+        user_states.pop(chat_id, None)
+    else:
+        await redis_client.delete(_session_key(chat_id))
+
+# Обновления одного чата обрабатываются строго по очереди: иначе два быстрых ответа (или двойное
+# нажатие кнопки) читают одно и то же состояние и перезаписывают друг друга, а finish_test
+# выполняется дважды. Внутри процесса очередь держит asyncio.Lock, между процессами — lock в Redis.
+
+CHAT_LOCK_TTL = 30  # секунд; lock в Redis освободится сам, если процесс упал, не сняв его
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+_chat_locks = {}  # chat_id -> [asyncio.Lock, число ожидающих/владеющих]
+
+@asynccontextmanager
+async def chat_lock(chat_id):
+    entry = _chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            if redis_client is None:
+                yield
+                return
+            key, token = f"lock:{chat_id}", os.urandom(8).hex()
+            while not await redis_client.set(key, token, nx=True, ex=CHAT_LOCK_TTL):
+                await asyncio.sleep(0.05)
+            try:
+                yield
+            finally:
+                # снимаем только свой lock (он мог истечь и достаться другому процессу)
+                await redis_client.eval(_RELEASE_LOCK_SCRIPT, 1, key, token)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _chat_locks[chat_id]
+
+async def start_test_for_user(chat_id, test_id, tg_user):
     """Инициализация состояния теста для пользователя."""
-    test = TESTS[test_id]
-    user_states[chat_id] = {
-        "test_id": test_id,
-        "test": test,
-        "stage": "get_name",
-        "index": 0,
-        "answers": {},
-        "start_time": time.time(),
-        "attempt": 1,
-        "telegram_id": tg_user.id,  # сохраняем id студента
-        "student_username": tg_user.username or ""
-    }
+    await set_state(chat_id, UserState(
+        test_id=test_id,
+        telegram_id=tg_user.id,
+        student_username=tg_user.username or "",
+    ))
 
 
 # Парсеры ответов (толерантные)
 
+_PAIR_ITER_RE = re.compile(r"([A-Za-z])\s*[-=:]?\s*(\d+)")
+_SEP_RE = re.compile(r"[,\.;]")
+_WS_RE = re.compile(r"\s")
+_TF_RE = re.compile(r"[TF]")
+_ALPHA_RE = re.compile(r"^[a-z]$")
+
 def normalize_choice(s):
     return (s or "").strip().lower()
 
@@ -135,22 +293,9 @@ def parse_matching_input(s):
     res = {}
     if not s:
         return res
-    # заменим разные разделители пробелом
-    s2 = s.replace(";", " ").replace(",", " ").replace(":", " ").strip()
-    # регулярка на пары: буква (a-i) + optional non-digit + число
-    parts = s2.split()
-    for p in parts:
-        m = re.match(r"^([A-Za-z])\s*[-=:]?\s*(\d+)$", p)
-        if m:
-            left = m.group(1).lower()
-            right = int(m.group(2))
-            res[left] = right
-        else:
-            # try contiguous like a2b1 (not very common) — fallback: search all letter-number pairs
-            for mm in re.finditer(r"([A-Za-z])\s*[-=:]?\s*(\d+)", p):
-                left = mm.group(1).lower()
-                right = int(mm.group(2))
-                res[left] = right
+    # один проход по всей строке: пары "буква [-=:] число", любые разделители между парами
+    for m in _PAIR_ITER_RE.finditer(s):
+        res[m.group(1).lower()] = int(m.group(2))
     return res
 
 def parse_tf_list_input(s):
@@ -166,9 +311,9 @@ def parse_tf_list_input(s):
     # оставим только буквы T или F (регистр игнорируем)
     s2 = s.upper()
     # заменим запятые и точки на пробелы
-    s2 = re.sub(r"[,\.;]", " ", s2)
+    s2 = _SEP_RE.sub(" ", s2)
     # если есть пробелы, разбиваем по пробелу и фильтруем
-    if re.search(r"\s", s2):
+    if _WS_RE.search(s2):
         parts = [p for p in s2.split() if p in ("T","F","TRUE","FALSE")]
         out = []
         for p in parts:
@@ -178,7 +323,7 @@ def parse_tf_list_input(s):
                 out.append("F")
         return out
     # если нет пробелов, вероятно запись слитно: TTFT...
-    compact = re.findall(r"[TF]", s2)
+    compact = _TF_RE.findall(s2)
     return compact
 
 def parse_ordering_input(s):
@@ -193,50 +338,96 @@ def parse_ordering_input(s):
     # если есть запятые или пробелы, разделяем
     if "," in s2:
         parts = [p.strip().lower() for p in s2.split(",") if p.strip()]
-    elif re.search(r"\s", s2):
+    elif _WS_RE.search(s2):
         parts = [p.strip().lower() for p in s2.split() if p.strip()]
     else:
         parts = list(s2.lower())
-    parts = [p for p in parts if re.match(r"^[a-z]$", p)]
+    parts = [p for p in parts if _ALPHA_RE.match(p)]
     return parts
 
 
 # Форматирование вопроса/ответа для отправки в чат
 
 def format_question_text(q):
-    text = f"❓ {q['text']}\n"
     t = q["type"]
+    parts = [f"❓ {q['text']}\n"]
     if t == "single":
         for i,opt in enumerate(q["options"]):
-            text += f"{chr(ord('a')+i)}. {opt}\n"
+            parts.append(f"{chr(ord('a')+i)}. {opt}\n")
     elif t == "matching":
-        text += "\nLeft:\n"
+        parts.append("\nLeft:\n")
         for idx,l in enumerate(q["left"]):
-            text += f"{chr(ord('a')+idx)}. {l}\n"
-        text += "\nRight:\n"
+            parts.append(f"{chr(ord('a')+idx)}. {l}\n")
+        parts.append("\nRight:\n")
         for idx,r in enumerate(q["right"], start=1):
-            text += f"{idx}. {r}\n"
-        text += "\n💬 Формат: a-8 b-3 c-4 (или a=2,b=1 и т.д.)"
+            parts.append(f"{idx}. {r}\n")
+        parts.append("\n💬 Формат: a-8 b-3 c-4 (или a=2,b=1 и т.д.)")
     elif t == "tf_list":
         for idx,item in enumerate(q["items"], start=1):
-            text += f"{idx}. {item}\n"
-        text += "\n💬 Формат: T F T ... или TTFT..."
+            parts.append(f"{idx}. {item}\n")
+        parts.append("\n💬 Формат: T F T ... или TTFT...")
     elif t == "ordering":
         for i,opt in enumerate(q["options"]):
-            text += f"{chr(ord('a')+i)}. {opt}\n"
-        text += "\n💬 Формат: a b c d e "
+            parts.append(f"{chr(ord('a')+i)}. {opt}\n")
+        parts.append("\n💬 Формат: a b c d e ")
     else:
-        text += "\n💬 Введите ваш ответ (текст)."
-    return text
+        parts.append("\n💬 Введите ваш ответ (текст).")
+    return "".join(parts)
 
-def make_inline_keyboard_for_testlist():
+def build_keyword_automaton(keywords):
+    """
+    Автомат Ахо–Корасик по ключевым словам: один проход по ответу находит все вхождения.
+    Значение слова — индексы его позиций в списке keywords (слова могут повторяться).
+    """
+    if not keywords:
+        return None
+    positions = {}
+    for i, kw in enumerate(keywords):
+        positions.setdefault(kw, []).append(i)
+    automaton = ahocorasick.Automaton()
+    for kw, idxs in positions.items():
+        automaton.add_word(kw, tuple(idxs))
+    automaton.make_automaton()
+    return automaton
+
+def prepare_question(q):
+    """Заранее вычисляет неизменяемые данные вопроса (вызывается один раз при загрузке тестов)."""
+    # id вопроса — ключ в state.answers; в JSON (Redis, all_answers_json) ключи всегда строки,
+    # поэтому приводим id к str сразу, иначе после загрузки сессии ответы не найдутся
+    q["id"] = str(q["id"])
+    q["_rendered_text"] = format_question_text(q)
+    # эталонные ответы в том виде, в котором их сравнивает grade_answers
+    t = q["type"]
+    if t == "matching":
+        q["_correct_map"] = {k.lower(): int(v) for k,v in q.get("answer", {}).items()}
+    elif t == "tf_list":
+        q["_correct_tf"] = [c.upper() for c in q.get("answer", [])]
+    elif t == "ordering":
+        q["_correct_order"] = [c.lower() for c in q.get("answer", [])]
+    elif t.startswith("free_text"):
+        # пустые строки пропускаем: "" входит в любой ответ и давал бы балл даром
+        q["_keywords_low"] = tuple(k.lower() for k in q.get("keywords") or [] if k)
+        q["_kw_automaton"] = build_keyword_automaton(q["_keywords_low"])
+
+# Тесты загружаются здесь, а не в начале модуля: prepare_question использует функции выше
+TESTS = load_tests()
+
+def _build_test_list_kb():
     kb = types.InlineKeyboardMarkup()
     for tid, t in TESTS.items():
         btn = types.InlineKeyboardButton(text=t.get("title", tid), callback_data=f"take::{tid}")
         kb.add(btn)
     return kb
 
+# TESTS не меняется после запуска, поэтому клавиатуры строятся один раз и переиспользуются
+TEST_LIST_KB = _build_test_list_kb()
+
+def make_inline_keyboard_for_testlist():
+    return TEST_LIST_KB
+
+@lru_cache(maxsize=256)
 def make_inline_keyboard_for_options(options):
+    """options — кортеж вариантов ответа (хешируемый ключ для кэша)."""
     kb = types.InlineKeyboardMarkup()
     for i,opt in enumerate(options):
         kb.add(types.InlineKeyboardButton(text=f"{chr(ord('a')+i)}. {opt}", callback_data=chr(ord('a')+i)))
@@ -291,7 +482,7 @@ def grade_answers(test, answers):
 
         # matching
         elif qtype == "matching":
-            correct_map = {k.lower(): int(v) for k,v in q.get("answer", {}).items()}
+            correct_map = q["_correct_map"]
             s_map = parse_matching_input(student_ans)
             matched = 0
             for left_key, corr in correct_map.items():
@@ -304,12 +495,10 @@ def grade_answers(test, answers):
 
         # tf_list
         elif qtype == "tf_list":
-            correct = [c.upper() for c in q.get("answer", [])]
+            correct = q["_correct_tf"]
             parts = parse_tf_list_input(student_ans)
-            matched = 0
-            for i, exp in enumerate(correct):
-                if i < len(parts) and parts[i] == exp:
-                    matched += 1
+            # map по двум спискам останавливается на более коротком; сравнение выполняется в C
+            matched = sum(map(eq, correct, parts))
             # баллы пропорционально правильным
             score = matched * (pts / max(1, len(correct)))
             details[qid] = {"type":"tf_list", "student": parts, "correct": correct,
@@ -317,12 +506,10 @@ def grade_answers(test, answers):
 
         # ordering
         elif qtype == "ordering":
-            correct = [c.lower() for c in q.get("answer", [])]
+            correct = q["_correct_order"]
             parts = parse_ordering_input(student_ans)
-            matched = 0
-            for i, exp in enumerate(correct):
-                if i < len(parts) and parts[i] == exp:
-                    matched += 1
+            # map по двум спискам останавливается на более коротком; сравнение выполняется в C
+            matched = sum(map(eq, correct, parts))
             score = matched * (pts / max(1, len(correct)))
             details[qid] = {"type":"ordering", "student": parts, "correct": correct,
                             "matched": matched, "total": len(correct), "score": round(score,2)}
@@ -330,13 +517,11 @@ def grade_answers(test, answers):
         # free_text and free_text_explain
         elif qtype.startswith("free_text"):
             manual_needed = True
-            keywords = [k.lower() for k in q.get("keywords", [])] if q.get("keywords") else []
+            keywords = q["_keywords_low"]
             found = 0
             if isinstance(student_ans, str) and student_ans.strip() and keywords:
                 low = student_ans.lower()
-                for kw in keywords:
-                    if kw in low:
-                        found += 1
+                found = len({i for _, idxs in q["_kw_automaton"].iter(low) for i in idxs})
                 ratio = found / len(keywords) if keywords else 0
                 score = round(min(pts, pts * ratio), 2)
             else:
@@ -366,20 +551,14 @@ def grade_answers(test, answers):
 
 
 # Сохранение результата в Google Sheet
+# Обработчик только кладёт готовую строку в очередь; фоновая задача забирает строки
+# пачками и пишет их через values.append в отдельном потоке, не блокируя цикл событий.
 
-def ensure_header_and_get_indices():
-    """
-    Возвращает header список и словарь column->index (1-based).
-    """
-    header = sheet.row_values(1)
-    # если заголовок неполный, обновим
-    if header[:len(BASE_HEADER)] != BASE_HEADER:
-        extra = header[len(BASE_HEADER):] if len(header) > len(BASE_HEADER) else []
-        new_header = BASE_HEADER + extra
-        sheet.update("A1", [new_header])
-        header = new_header
-    indices = {h: i+1 for i,h in enumerate(header)}
-    return header, indices
+SHEET_BATCH_MAX = 20
+SHEET_SHUTDOWN_TIMEOUT = 30
+SHEET_WRITE_ATTEMPTS = 8  # для ошибок, которые не лечатся ожиданием (4xx, сбои вне API)
+UNSAVED_RESULTS_FILE = "unsaved_results.jsonl"  # сюда попадают строки, которые так и не удалось записать
+_sheet_q = asyncio.Queue()  # элементы: (заголовок, по которому собрана строка, строка)
 
 def save_result_to_sheet(test, state, result):
     """
@@ -387,37 +566,171 @@ def save_result_to_sheet(test, state, result):
     """
     if not sheet:
         return
-    header, indices = ensure_header_and_get_indices()
-    # подготовка row_map
-    row_map = {h: "" for h in header}
-    row_map["timestamp"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
-    row_map["student_name"] = state.get("student_name", "")
-    row_map["group"] = state.get("group", "")
-    row_map["test_id"] = state.get("test_id", "")
-    row_map["test_title"] = test.get("title", "")
-    row_map["score"] = result["score"]
-    row_map["max_score"] = result["max_score"]
-    row_map["auto_score"] = result["auto_score"]
-    row_map["manual_needed"] = "YES" if result["manual_needed"] else "NO"
-    row_map["manual_score_total"] = ""  # преподаватель вписывает вручную
-    row_map["teacher_comment"] = ""
-    row_map["all_answers_json"] = json.dumps(state["answers"], ensure_ascii=False)
+    # строка в порядке закэшированного заголовка; индексы в INDEX_CACHE 1-based.
+    # manual_score_total, teacher_comment, manual_score_q12/q13 и notified остаются пустыми:
+    # их заполняет преподаватель (и бот после рассылки)
+    idx = INDEX_CACHE
+    row = [""] * len(HEADER_CACHE)
+    t = time.gmtime()
+    row[idx["timestamp"]-1] = (f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d} "
+                               f"{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d} UTC")
+    row[idx["student_name"]-1] = state.student_name
+    row[idx["group"]-1] = state.group
+    row[idx["test_id"]-1] = state.test_id
+    row[idx["test_title"]-1] = test.get("title", "")
+    row[idx["score"]-1] = result["score"]
+    row[idx["max_score"]-1] = result["max_score"]
+    row[idx["auto_score"]-1] = result["auto_score"]
+    row[idx["manual_needed"]-1] = "YES" if result["manual_needed"] else "NO"
+    # q12/q13 пишутся в отдельные колонки, в JSON их не дублируем
+    answers_for_json = {k: v for k,v in state.answers.items() if k not in ("q12","q13")}
+    row[idx["all_answers_json"]-1] = orjson.dumps(answers_for_json, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
     # открытые вопросы отдельно (если есть)
-    row_map["q12_raw"] = state["answers"].get("q12", "")
-    row_map["q13_raw"] = state["answers"].get("q13", "")
-    row_map["manual_score_q12"] = ""
-    row_map["manual_score_q13"] = ""
-    row_map["telegram_id"] = str(state.get("telegram_id", ""))
-    row_map["notified"] = ""  # пометка о рассылке после проверки
+    row[idx["q12_raw"]-1] = state.answers.get("q12", "")
+    row[idx["q13_raw"]-1] = state.answers.get("q13", "")
+    row[idx["telegram_id"]-1] = str(state.telegram_id)
+    _sheet_q.put_nowait((HEADER_CACHE, row))
+
+def _take_batch(first):
+    """Добирает из очереди уже накопившиеся элементы (не больше SHEET_BATCH_MAX)."""
+    items = [first]
+    while len(items) < SHEET_BATCH_MAX:
+        try:
+            items.append(_sheet_q.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return items
+
+def _append_values(rows):
+    """Один POST spreadsheets.values.append без обёртки Worksheet.append_rows."""
+    sheet.spreadsheet.values_append(
+        absolute_range_name(sheet.title, "A1"),
+        params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+        body={"values": rows},
+    )
+
+def _align_row(header, row):
+    """Переставляет строку, собранную по header, под текущий HEADER_CACHE."""
+    if header is HEADER_CACHE:
+        return row
+    pos = {h: i for i,h in enumerate(header)}
+    return [row[pos[h]] if h in pos else "" for h in HEADER_CACHE]
+
+def _spill_rows(items):
+    """Сохраняет незаписанные строки в UNSAVED_RESULTS_FILE (JSON по строке: колонка -> значение)."""
+    with open(UNSAVED_RESULTS_FILE, "ab") as f:
+        for header, row in items:
+            f.write(orjson.dumps(dict(zip(header, row))) + b"\n")
+
+async def _write_rows(items):
+    """
+    Дописывает пачку строк в таблицу. При превышении квоты (429) и ошибках сервера
+    повторяет запись с экспоненциальной задержкой, пока она не удастся.
+    Прочие ошибки повторяются не больше SHEET_WRITE_ATTEMPTS раз (после отказа API заголовок
+    перечитывается и строки пересобираются под него); если запись так и не удалась,
+    строки сохраняются в UNSAVED_RESULTS_FILE, чтобы не задерживать очередь и не потерять их.
+    Паузы выдерживаются через asyncio.sleep, чтобы не занимать поток и не мешать остановке.
+    """
+    delay = 1.0
+    failures = 0
+    while True:
+        wait = delay
+        try:
+            await asyncio.to_thread(_append_values, [_align_row(h, row) for h, row in items])
+            return
+        except gspread.exceptions.APIError as e:
+            if _is_retryable(e):
+                wait = _retry_delay(e, delay)
+                print(f"Google Sheets вернул {e.response.status_code}, повтор через {wait:.0f} с")
+            else:
+                failures += 1
+                print(f"Google Sheets отклонил запись {len(items)} строк(и) "
+                      f"(попытка {failures}/{SHEET_WRITE_ATTEMPTS}): {e}")
+                # возможно, изменилась структура таблицы — перечитываем заголовок
+                try:
+                    await asyncio.to_thread(refresh_header_cache)
+                except Exception as exc:
+                    print(f"Не удалось перечитать заголовок таблицы: {exc}")
+        except Exception as e:
+            failures += 1
+            print(f"Не удалось записать {len(items)} строк(и) в Google Sheets "
+                  f"(попытка {failures}/{SHEET_WRITE_ATTEMPTS}): {e}")
+        if failures >= SHEET_WRITE_ATTEMPTS:
+            try:
+                _spill_rows(items)
+                print(f"❌ {len(items)} строк(и) не записаны в Google Sheets и сохранены в {UNSAVED_RESULTS_FILE}")
+            except Exception as exc:
+                print(f"❌ {len(items)} строк(и) не записаны ни в Google Sheets, ни в {UNSAVED_RESULTS_FILE}: "
+                      f"{exc}\nСтроки: {items}")
+            return
+        await asyncio.sleep(wait)
+        delay = min(delay * 2, SHEET_RETRY_MAX_DELAY)
 
-    # формируем строку в порядке header
-    row = [row_map.get(h, "") for h in header]
-    sheet.append_row(row)
+async def _sheet_worker():
+    while True:
+        items = _take_batch(await _sheet_q.get())
+        try:
+            await _write_rows(items)
+        except asyncio.CancelledError:
+            # остановка посреди записи: сохраняем пачку локально (возможен дубль, но не потеря)
+            _spill_rows(items)
+            raise
+        finally:
+            for _ in items:
+                _sheet_q.task_done()
+
+_sheet_worker_task = None
+
+def start_sheet_worker():
+    global _sheet_worker_task
+    if sheet:
+        _sheet_worker_task = asyncio.create_task(_sheet_worker())
+
+async def stop_sheet_worker():
+    """Дожидается записи строк, оставшихся в очереди, и останавливает фоновую задачу."""
+    global _sheet_worker_task
+    if _sheet_worker_task is None:
+        return
+    try:
+        await asyncio.wait_for(_sheet_q.join(), SHEET_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    _sheet_worker_task.cancel()
+    try:
+        await _sheet_worker_task
+    except asyncio.CancelledError:
+        pass
+    _sheet_worker_task = None
+    left = []
+    while not _sheet_q.empty():
+        left.append(_sheet_q.get_nowait())
+    if left:
+        _spill_rows(left)
+        print(f"Не записано в Google Sheets при остановке: {len(left)} строк(и), сохранены в {UNSAVED_RESULTS_FILE}")
 
 # Telegram handlers
 
+_handlers_in_flight = 0
+_handlers_idle = asyncio.Event()
+_handlers_idle.set()
+
+def _tracked(handler):
+    """Учитывает выполняющиеся обработчики, чтобы при остановке дождаться их завершения."""
+    @wraps(handler)
+    async def wrapper(*args, **kwargs):
+        global _handlers_in_flight
+        _handlers_in_flight += 1
+        _handlers_idle.clear()
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            _handlers_in_flight -= 1
+            if not _handlers_in_flight:
+                _handlers_idle.set()
+    return wrapper
+
 @bot.message_handler(commands=["start", "help"])
-def cmd_start(message):
+async def cmd_start(message):
     """
     Показываем список тестов как inline-кнопки.
     Сохраняем telegram_id, но не просим email — уведомления будут в Telegram.
@@ -425,109 +738,115 @@ def cmd_start(message):
     chat_id = message.chat.id
     text = "👋 Привет! Я бот для тестирования.\n\nВыберите тест:"
     if not TESTS:
-        bot.send_message(chat_id, text + "\n(Тесты не найдены в папке tests/)")
+        await bot.send_message(chat_id, text + "\n(Тесты не найдены в папке tests/)")
         return
     kb = make_inline_keyboard_for_testlist()
-    bot.send_message(chat_id, text, reply_markup=kb)
+    await bot.send_message(chat_id, text, reply_markup=kb)
 
 # Обработчик нажатий кнопок (выбор теста)
 @bot.callback_query_handler(func=lambda call: True)
-def callback_query_handler(call):
+@_tracked
+async def callback_query_handler(call):
     data = call.data
     chat_id = call.message.chat.id
-    # команда на взятие теста
-    if data.startswith("take::"):
-        test_id = data.split("::", 1)[1]
-        if test_id not in TESTS:
-            bot.answer_callback_query(call.id, "Тест не найден.")
+    async with chat_lock(chat_id):
+        # команда на взятие теста
+        if data.startswith("take::"):
+            test_id = data.split("::", 1)[1]
+            if test_id not in TESTS:
+                await bot.answer_callback_query(call.id, "Тест не найден.")
+                return
+            # инициализация состояния: используем message.from_user
+            await start_test_for_user(chat_id, test_id, call.from_user)
+            await bot.answer_callback_query(call.id, f"Вы выбрали тест: {TESTS[test_id].get('title')}")
+            await bot.send_message(chat_id, "Пожалуйста, введите ваше ФИО (полностью):")
             return
-        # инициализация состояния: используем message.from_user
-        start_test_for_user(chat_id, test_id, call.from_user)
-        bot.answer_callback_query(call.id, f"Вы выбрали тест: {TESTS[test_id].get('title')}")
-        bot.send_message(chat_id, "Пожалуйста, введите ваше ФИО (полностью):")
-        return
 
-    # single-choice ответ (a/b/c) — обрабатываем как выбор для текущего вопроса если это single
-    state = user_states.get(chat_id)
-    if state:
-        # защитимся от неактивных состояний
-        try:
-            q = state["test"]["questions"][state["index"]]
-        except Exception:
-            q = None
-        if q and q["type"] == "single" and data in ("a","b","c","d","e","f","g","h"):
-            qid = q["id"]
-            state["answers"][qid] = data
-            bot.answer_callback_query(call.id, f"Вы выбрали: {data}")
-            # удаляем сообщение с кнопками для чистоты чата
+        # single-choice ответ (a/b/c) — обрабатываем как выбор для текущего вопроса если это single
+        state = await get_state(chat_id)
+        if state:
+            # защитимся от неактивных состояний
             try:
-                bot.delete_message(chat_id, call.message.message_id)
+                q = state.test["questions"][state.index]
             except Exception:
-                pass
-            state["index"] += 1
-            # следующая стадия
-            if state["index"] < len(state["test"]["questions"]):
-                send_question_to_user(chat_id, state["test"]["questions"][state["index"]])
-            else:
-                finish_test(chat_id)
-            return
-    bot.answer_callback_query(call.id, "Нажата неизвестная кнопка.")
-
-def send_question_to_user(chat_id, q):
+                q = None
+            if q and q["type"] == "single" and data in ("a","b","c","d","e","f","g","h"):
+                qid = q["id"]
+                state.answers[qid] = data
+                await bot.answer_callback_query(call.id, f"Вы выбрали: {data}")
+                # удаляем сообщение с кнопками для чистоты чата
+                try:
+                    await bot.delete_message(chat_id, call.message.message_id)
+                except Exception:
+                    pass
+                state.index += 1
+                # следующая стадия
+                if state.index < len(state.test["questions"]):
+                    await set_state(chat_id, state)
+                    await send_question_to_user(chat_id, state.test["questions"][state.index])
+                else:
+                    await finish_test(chat_id, state)
+                return
+        await bot.answer_callback_query(call.id, "Нажата неизвестная кнопка.")
+
+async def send_question_to_user(chat_id, q):
     """Отправляет вопрос пользователю (inline для single)"""
+    text = q.get("_rendered_text") or format_question_text(q)
     if q["type"] == "single":
-        kb = make_inline_keyboard_for_options(q["options"])
-        bot.send_message(chat_id, format_question_text(q), reply_markup=kb)
+        kb = make_inline_keyboard_for_options(tuple(q["options"]))
+        await bot.send_message(chat_id, text, reply_markup=kb)
     else:
-        bot.send_message(chat_id, format_question_text(q))
+        await bot.send_message(chat_id, text)
 
 @bot.message_handler(func=lambda m: True)
-def handle_text_message(message):
+@_tracked
+async def handle_text_message(message):
     chat_id = message.chat.id
     text = message.text.strip() if message.text else ""
-    state = user_states.get(chat_id)
-    if not state:
-        bot.send_message(chat_id, "Отправьте /start чтобы начать тест.")
-        return
+    async with chat_lock(chat_id):
+        state = await get_state(chat_id)
+        if not state:
+            await bot.send_message(chat_id, "Отправьте /start чтобы начать тест.")
+            return
 
-    stage = state["stage"]
-    if stage == "get_name":
-        state["student_name"] = text
-        state["stage"] = "get_group"
-        bot.send_message(chat_id, "Введите вашу группу:")
-        return
+        stage = state.stage
+        if stage == "get_name":
+            state.student_name = text
+            state.stage = "get_group"
+            await set_state(chat_id, state)
+            await bot.send_message(chat_id, "Введите вашу группу:")
+            return
 
-    if stage == "get_group":
-        state["group"] = text
-        state["stage"] = "asking"
-        state["index"] = 0
-        bot.send_message(chat_id, f"🎬 Начинаем тест: {state['test']['title']}")
-        # send first question
-        send_question_to_user(chat_id, state["test"]["questions"][0])
-        return
+        if stage == "get_group":
+            state.group = text
+            state.stage = "asking"
+            state.index = 0
+            await set_state(chat_id, state)
+            await bot.send_message(chat_id, f"🎬 Начинаем тест: {state.test['title']}")
+            # send first question
+            await send_question_to_user(chat_id, state.test["questions"][0])
+            return
 
-    if stage == "asking":
-        # сохраняем ответ на текущий вопрос как есть
-        q = state["test"]["questions"][state["index"]]
-        qid = q["id"]
-        # Сохраняем raw-ответ (строка)
-        state["answers"][qid] = text
-        state["index"] += 1
-        if state["index"] < len(state["test"]["questions"]):
-            send_question_to_user(chat_id, state["test"]["questions"][state["index"]])
-        else:
-            finish_test(chat_id)
-        return
+        if stage == "asking":
+            # сохраняем ответ на текущий вопрос как есть
+            q = state.test["questions"][state.index]
+            qid = q["id"]
+            # Сохраняем raw-ответ (строка)
+            state.answers[qid] = text
+            state.index += 1
+            if state.index < len(state.test["questions"]):
+                await set_state(chat_id, state)
+                await send_question_to_user(chat_id, state.test["questions"][state.index])
+            else:
+                await finish_test(chat_id, state)
+            return
 
 
 # Завершение теста: оценка, отчёт, запись
 
-def finish_test(chat_id):
-    state = user_states.get(chat_id)
-    if not state:
-        return
-    test = state["test"]
-    result = grade_answers(test, state["answers"])
+async def finish_test(chat_id, state):
+    test = state.test
+    result = grade_answers(test, state.answers)
 
     # формируем подробный разбор для студента
     lines = []
@@ -573,7 +892,7 @@ def finish_test(chat_id):
             lines.append(f"   Ваш ответ: {info.get('student','(пустой)')}")
         else:
             lines.append(f"Q: {qtext}")
-            lines.append(f"   Ответ: {state['answers'].get(qid,'')}")
+            lines.append(f"   Ответ: {state.answers.get(qid,'')}")
     # итог
     report = "\n\n".join(lines)
     summary = (f"✅ Тест завершён!\n\n📊 Автоматический разбор:\n\n{report}\n\n"
@@ -584,19 +903,72 @@ def finish_test(chat_id):
     # сохраняем в Google Sheets
     try:
         save_result_to_sheet(test, state, result)
-        sheet_msg = "Результат сохранён в Google Sheets."
+        sheet_msg = "Результат принят и будет сохранён в Google Sheets."
     except Exception as e:
         sheet_msg = f"⚠️ Не удалось сохранить в Google Sheets: {e}"
 
     # отправляем студенту
-    bot.send_message(chat_id, summary + "\n" + sheet_msg)
+    await bot.send_message(chat_id, summary + "\n" + sheet_msg)
 
     # удаляем состояние
-    del user_states[chat_id]
+    await pop_state(chat_id)
+
+
+# HTTP и запуск
+# Одно aiohttp-приложение в одном цикле событий обслуживает healthcheck (GET /) и бота:
+# при заданном PUBLIC_URL — через webhook (POST /<token>), иначе — long polling фоновой задачей.
 
+async def index(request):
+    return web.Response(text="Bot is running!")
 
-# Запуск бота
+async def telegram_webhook(request):
+    """Принимает обновления от Telegram и передаёт их обработчикам бота."""
+    update = types.Update.de_json(await request.json())
+    await bot.process_new_updates([update])
+    return web.Response()
+
+_polling_task = None
+
+async def _on_startup(app):
+    global _polling_task
+    start_sheet_worker()
+    if CFG.public_url:
+        await bot.remove_webhook()
+        await bot.set_webhook(url=f"{CFG.public_url.rstrip('/')}/{CFG.token}")
+    else:
+        # webhook мог остаться от прошлого запуска с PUBLIC_URL: пока он задан, getUpdates отвечает 409
+        await bot.remove_webhook()
+        # infinity_polling сам переподключается после ошибок; long polling держит запрос до 60 с,
+        # поэтому таймаут HTTP-запроса берём с запасом
+        _polling_task = asyncio.create_task(
+            bot.infinity_polling(timeout=60, request_timeout=90, logger_level=logging.ERROR))
+
+async def _on_cleanup(app):
+    if _polling_task is not None:
+        _polling_task.cancel()
+        try:
+            await _polling_task
+        except asyncio.CancelledError:
+            pass
+    # обработчики, запущенные polling'ом отдельными задачами, ещё могут поставить строки в очередь
+    try:
+        await asyncio.wait_for(_handlers_idle.wait(), SHEET_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"Остановка: не дождались завершения обработчиков ({_handlers_in_flight})")
+    await stop_sheet_worker()
+    # сессия aiohttp создаётся при первом запросе к Telegram
+    if asyncio_helper.session_manager.session is not None:
+        await bot.close_session()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+app = web.Application()
+app.router.add_get("/", index)
+if CFG.public_url:
+    app.router.add_post(f"/{CFG.token}", telegram_webhook)
+app.on_startup.append(_on_startup)
+app.on_cleanup.append(_on_cleanup)
 
 if __name__ == "__main__":
-    print(" Bot running...")
-    bot.infinity_polling()
+    print(f" Bot running ({'webhook' if CFG.public_url else 'polling'})...")
+    web.run_app(app, port=CFG.port)